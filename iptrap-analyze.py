@@ -1,94 +1,160 @@
 #!/usr/bin/python3
 
+import argparse
+import csv
 import os
-import sys
-import re
+from collections.abc import Iterable
+import numpy as np
 import pandas as pd
+import matplotlib
 import matplotlib.pyplot as plt
-import geoip2.database
+import maxminddb
+try:
+	import re2 as re  # optional, linear-time matching is faster on large logs
+except ImportError:
+	import re
 
 
-# Configurable arguments
-logDir: str = "/var/log"
-dbDir: str = "."
-flInteractive: bool = False
-flNoGeo: bool = False  #TODO: implement this option
+# Default arguments
+defaultLogDir: str = "/var/log"
+defaultDbDir: str = "."
 
 # File names
 logName: str = "iptrap.log"
-countryDbName: str = "GeoLite2-Country.mmdb"
 cityDbName: str = "GeoLite2-City.mmdb"
 
-# Lists to store the parsed data
-dates = []
-ips = []
-protocols = []
-ports = []
-countries = []
-cities = []
-
-# Regex pattern to extract relevant information
-pattern = re.compile(r"\[(?P<datetime>[^\]]+)\] \[(?P<protocol>ipv[46])\] Caught (?P<ip>[\d\.]+|[\da-f:]+) on port (?P<port>\d+)")
-
-# Parse arguments from command line
-#TODO: consider using argparse when the project is getting bigger
-if len(sys.argv) > 1:
-	for arg in sys.argv[1:]:
-		if arg.startswith("--logdir="):
-			logDir = arg[9:]
-		elif arg.startswith("--dbdir="):
-			dbDir = arg[8:]
-		elif arg == "-i" or arg == "--interactive":
-			flInteractive = True
-
-# Load the log
-if os.path.isdir(logDir) and os.access(logDir, os.R_OK):
+# Columns of the tab-separated log
+logColumns: list[str] = ["datetime", "protocol", "ip", "port"]
+
+# Number of log lines to read at a time, keeps memory usage bounded on very large logs
+logChunkSize: int = 1000000
+
+# Regex pattern to extract relevant information from logs written by older versions of IPTrap
+pattern = re.compile(r"(?m)^\[(?P<datetime>[^\]]+)\] \[(?P<protocol>ipv[46])\] Caught (?P<ip>[\d\.]+|[\da-f:]+) on port (?P<port>\d+)")
+
+# Parsed records and MaxMind GeoIP2 database reader, filled in by main()
+data: pd.DataFrame | None = None
+cityReader: maxminddb.Reader | None = None
+
+# Aggregations shared by the chart functions, filled in by countBlocks()
+ipCountsPerDay: pd.Series | None = None
+portCounts: pd.Series | None = None
+protocolCounts: pd.Series | None = None
+countryCounts: pd.Series | None = None
+
+# Save charts as PNG files instead of opening a window, set by main() when not running interactively
+saveCharts: bool = False
+
+
+def parseArgs() -> argparse.Namespace:
+	parser = argparse.ArgumentParser(description="Analyze the log written by IPTrap")
+	parser.add_argument("--logdir", default=defaultLogDir, help=f"directory containing {logName} (default: {defaultLogDir})")
+	parser.add_argument("--dbdir", default=defaultDbDir, help=f"directory containing the MaxMind GeoIP2 city database {cityDbName} (default: {defaultDbDir})")
+	parser.add_argument("-i", "--interactive", action="store_true", help="open an interactive console instead of displaying all charts")
+	#TODO: add a "--nogeo" option to skip the GeoIP2 lookups
+	return parser.parse_args()
+
+
+def loadLog(logDir: str) -> Iterable[pd.DataFrame]:
+	if not (os.path.isdir(logDir) and os.access(logDir, os.R_OK)):
+		raise Exception("Invalid log directory: \"" + logDir + "\" (change the direcroty with \"--logdir=<directory>\")")
 	log_path: str = os.path.join(logDir, logName)
 	print("Loading IPTrap log from", log_path)
-	with open(log_path, "r") as file:
-		rawData = file.readlines()
-else:
-	raise Exception("Invalid log directory: \"" + logDir + "\" (change the direcroty with \"--logdir=<directory>\")")
-
-# Load MaxMind GeoIP2 database
-if os.path.isdir(dbDir) and os.access(dbDir, os.R_OK):
-	country_db_path: str = os.path.join(dbDir, countryDbName)
+	try:
+		return pd.read_csv(log_path, sep="\t", names=logColumns, dtype=str, quoting=csv.QUOTE_NONE, engine="c", chunksize=logChunkSize)
+	except pd.errors.EmptyDataError:
+		return [pd.DataFrame(columns=logColumns, dtype=str)]
+
+
+def loadDatabases(dbDir: str) -> None:
+	global cityReader
+	if not (os.path.isdir(dbDir) and os.access(dbDir, os.R_OK)):
+		raise Exception("Invalid database directory: \"" + dbDir + "\" (change the direcroty with \"--dbdir=<directory>\")")
 	city_db_path: str = os.path.join(dbDir, cityDbName)
-	print("Loading MaxMind GeoIP2 country database from", country_db_path)
-	countryReader = geoip2.database.Reader(country_db_path)
 	print("Loading MaxMind GeoIP2 city database from", city_db_path)
-	cityReader = geoip2.database.Reader(city_db_path)
-else:
-	raise Exception("Invalid database directory: \"" + dbDir + "\" (change the direcroty with \"--dbdir=<directory>\")")
-
-print("Parsing")
-for line in rawData:
-	match = pattern.search(line)
-	if match:
-		datetime_str = match.group("datetime")
-		date_str = datetime_str.split()[0]
-		ip = match.group("ip")
-		protocol = match.group("protocol")
-		port = match.group("port")
-
-		dates.append(date_str)
-		ips.append(ip)
-		protocols.append(protocol)
-		ports.append(port)
-		try:
-			countries.append(countryReader.country(ip).country.name)
-		except geoip2.errors.AddressNotFoundError:
-			countries.append("Unknown")
-		try:
-			cities.append(cityReader.city(ip).city.name)
-		except geoip2.errors.AddressNotFoundError:
-			cities.append("Unknown")
-
-# Create a DataFrame from the parsed data
-print("Formatting")
-data: pd.DataFrame = pd.DataFrame({"date": dates, "ip": ips, "protocol": protocols, "port": ports, "countries": countries, "cities": cities})
-print("Deduplicating")
-data.drop_duplicates(subset=["date", "ip"], inplace=True)
+	cityReader = maxminddb.open_database(city_db_path)
+
+
+def parseChunk(records: pd.DataFrame) -> pd.DataFrame:
+	# Lines written by older versions have no tabs and end up in the first column only, parse those with the regex
+	legacy = records["ip"].isna()
+	if legacy.any():
+		legacyRecords = pd.DataFrame(pattern.findall("\n".join(records.loc[legacy, "datetime"].dropna())), columns=logColumns)
+		records = pd.concat([legacyRecords, records[~legacy]], ignore_index=True)
+	records.dropna(inplace=True)
+
+	# Timestamps are always written as "%Y-%m-%d %H:%M:%S", so the date is the first 10 characters
+	records.insert(0, "date", records.pop("datetime").str[:10])
+	records.insert(1, "ip", records.pop("ip"))
+
+	# Deduplicate before any further per-row work, most rows are repeated hits from the same IP on the same day
+	records.drop_duplicates(subset=["date", "ip"], inplace=True)
+	return records
+
+
+def parseLog(chunks: Iterable[pd.DataFrame]) -> pd.DataFrame:
+	print("Parsing")
+	records = pd.concat([parseChunk(chunk) for chunk in chunks], ignore_index=True)
+	# The same IP and day can still show up in more than one chunk
+	print("Deduplicating")
+	records.drop_duplicates(subset=["date", "ip"], inplace=True)
+	return records
+
+
+# Look up each unique IP only once, the same IP usually shows up many times in the log
+# The raw maxminddb records are used directly, only the English names are needed
+# The city database also contains the country, so a single read gives both
+def lookupLocation(ip: str) -> tuple[str, str]:
+	record = cityReader.get(ip) or {}
+	country = record.get("country", {}).get("names", {}).get("en", "Unknown")
+	city = record.get("city", {}).get("names", {}).get("en", "Unknown")
+	return country, city
+
+
+def addLocations(records: pd.DataFrame) -> pd.DataFrame:
+	print("Looking up locations")
+	# Number every unique IP once, the results are then picked by integer code instead of hashing IP strings again
+	ipCodes, uniqueIps = pd.factorize(records["ip"])
+	locations = [lookupLocation(ip) for ip in uniqueIps]
+	countryNames = np.array([country for country, _ in locations], dtype=object)
+	cityNames = np.array([city for _, city in locations], dtype=object)
+
+	# Build the final DataFrame from the parsed data
+	print("Formatting")
+	records["countries"] = countryNames[ipCodes]
+	records["cities"] = cityNames[ipCodes]
+	# Only a handful of distinct values exist in these columns, categories make counting them much cheaper
+	records["protocol"] = records["protocol"].astype("category")
+	records["port"] = pd.to_numeric(records["port"], downcast="unsigned").astype("category")
+	records["countries"] = records["countries"].astype("category")
+	return records
+
+
+######################################################
+# Show the current figure, or save it in headless mode
+######################################################
+def showChart(name: str) -> None:
+	if saveCharts:
+		path = f"iptrap_{name}.png"
+		plt.savefig(path, dpi=100)
+		plt.close()
+		print("Saved chart to", path)
+	else:
+		plt.show()
+
+
+##########################################################
+# Compute every aggregation the charts need in one place
+##########################################################
+def countBlocks() -> None:
+	global ipCountsPerDay, portCounts, protocolCounts, countryCounts
+	# Count the number of unique IPs blocked per day
+	ipCountsPerDay = data.groupby("date").size()
+	# Count the number of unique IPs blocked by each port
+	portCounts = data["port"].value_counts()
+	# Count the number of unique IPv4 and IPv6 addresses
+	protocolCounts = data["protocol"].value_counts()
+	countryCounts = data["countries"].value_counts()
 
 
 ############################################################
@@ -96,22 +162,19 @@ data.drop_duplicates(subset=["date", "ip"], inplace=True)
 ############################################################
 def chartIpBlocks() -> None:
 	print("Displaying: number of IPs blocked per day")
-
-	# Count the number of unique IPs blocked per day
-	ip_counts_per_day = data.groupby("date").size()
-	print(ip_counts_per_day)
+	print(ipCountsPerDay)
 
 	# Plot the line graph for the number of IPs blocked per day
 	plt.figure(figsize=(16, 9))
-	plt.plot(ip_counts_per_day.index, ip_counts_per_day.values, marker="o")
+	plt.plot(ipCountsPerDay.index, ipCountsPerDay.values, marker="o")
 	plt.title("Number of Blocked IPs Per Day")
 	plt.xlabel("Date")
 	plt.ylabel("Number of Unique IPs")
 	plt.xticks(rotation=30)
 	plt.grid(True)
-	plt.gca().xaxis.set_major_locator(plt.MaxNLocator(nbins=ip_counts_per_day.size // 7))
+	plt.gca().xaxis.set_major_locator(plt.MaxNLocator(nbins=ipCountsPerDay.size // 7))
 	plt.tight_layout()
-	plt.show()
+	showChart("ip_blocks")
 
 
 #########################################################
@@ -119,17 +182,14 @@ def chartIpBlocks() -> None:
 #########################################################
 def chartPortBlocks() -> None:
 	print("Displaying: percentage of ports blocked")
-
-	# Count the number of unique IPs blocked by each port
-	port_counts = data["port"].value_counts()
-	print(port_counts)
+	print(portCounts)
 
 	# Plot the pie chart for the percentage of IPs blocked by port
 	plt.figure(figsize=(16, 9))
-	plt.pie(port_counts, labels=port_counts.index, autopct="%1.3f%%", startangle=140)
+	plt.pie(portCounts, labels=portCounts.index, autopct="%1.3f%%", startangle=140)
 	plt.title("Percentage of Blocked IPs by Port")
 	plt.axis("equal")
-	plt.show()
+	showChart("port_blocks")
 
 
 #################################################################
@@ -137,17 +197,14 @@ def chartPortBlocks() -> None:
 #################################################################
 def chartFamilyBlocks() -> None:
 	print("Displaying: percentage of IPv4 and IPv6 blocked")
-
-	# Count the number of unique IPv4 and IPv6 addresses
-	protocol_counts = data["protocol"].value_counts()
-	print(protocol_counts)
+	print(protocolCounts)
 
 	# Plot the pie chart for the percentage of IPv4 and IPv6 blocked
 	plt.figure(figsize=(16, 9))
-	plt.pie(protocol_counts, labels=protocol_counts.index, autopct="%1.3f%%", startangle=140)
+	plt.pie(protocolCounts, labels=protocolCounts.index, autopct="%1.3f%%", startangle=140)
 	plt.title("Percentage of IPv4 and IPv6 Blocked")
 	plt.axis("equal")
-	plt.show()
+	showChart("family_blocks")
 
 
 ##################################################################
@@ -155,15 +212,13 @@ def chartFamilyBlocks() -> None:
 ##################################################################
 def chartCountryBlocks() -> None:
 	print("Displaying: percentage of blocked IPs by country")
-
-	country_counts = data["countries"].value_counts()
-	print(country_counts)
+	print(countryCounts)
 
 	plt.figure(figsize=(16, 9))
-	plt.pie(country_counts, labels=country_counts.index, autopct="%1.3f%%", startangle=140)
+	plt.pie(countryCounts, labels=countryCounts.index, autopct="%1.3f%%", startangle=140)
 	plt.title("Percentage of Blocked IPs by Country")
 	plt.axis("equal")
-	plt.show()
+	showChart("country_blocks")
 
 
 #####################
@@ -176,22 +231,38 @@ def chartAll() -> None:
 	chartCountryBlocks()
 
 
-if flInteractive:
-	import readline # optional, will allow Up/Down/History in the console
-	import code
-	variables = globals().copy()
-	variables.update(locals())
-	shell = code.InteractiveConsole(variables)
-	print("Done! All records stored in DataFrame object \"data\"")
-	print("""Available functions:
+def main() -> None:
+	global data, saveCharts
+	args = parseArgs()
+	if not args.interactive:
+		# Render off-screen without starting any GUI toolkit, this also works without a display
+		matplotlib.use("Agg")
+		saveCharts = True
+	chunks = loadLog(args.logdir)
+	loadDatabases(args.dbdir)
+	data = addLocations(parseLog(chunks))
+	countBlocks()
+
+	if args.interactive:
+		import readline # optional, will allow Up/Down/History in the console
+		import code
+		variables = globals().copy()
+		variables.update(locals())
+		shell = code.InteractiveConsole(variables)
+		print("Done! All records stored in DataFrame object \"data\"")
+		print("""Available functions:
+	countBlocks() (run again after changing "data")
 	chartAll()
 	chartIpBlocks()
 	chartPortBlocks()
 	chartFamilyBlocks()
 	chartCountryBlocks()""")
-	print("Press Ctrl+D or use \"exit()\" to exit")
-	shell.interact()
-else:
-	print("For interactive operation, run the script with argument \"-i\"")
-	chartAll()
-	exit()
+		print("Press Ctrl+D or use \"exit()\" to exit")
+		shell.interact()
+	else:
+		print("For interactive operation, run the script with argument \"-i\"")
+		chartAll()
+
+
+if __name__ == "__main__":
+	main()
@@ -1,51 +1,49 @@
 #!/usr/bin/python3
 
 import datetime
+import os
+import selectors
 import signal
 import socket
 import subprocess
 import sys
+import threading
 import time
-from multiprocessing import Process
+from multiprocessing import Event, Process
+from typing import TextIO
 
+# Bans are collected and handed to firewall-cmd in batches, spawning it once per IP is far slower than the ban itself
+BAN_BATCH_SIZE: int = 64
+BAN_FLUSH_INTERVAL: float = 1.0
 
-def isLoopback(ip: str) -> bool:
-    return ip in ["127.0.0.1", "::1"]
+# With "--traps=<n>", several traps share each port through SO_REUSEPORT so the kernel can spread connections across cores
+# Each trap batches its own bans, so more traps also mean more firewall-cmd calls
+DEFAULT_TRAPS_PER_PORT: int = 1
+LISTEN_BACKLOG: int = 1024
 
+LOG_PATH: str = "/var/log/iptrap.log"
 
-def isIpv4MappedIpv6(ip: str) -> bool:
-    try:
-        rawIp = socket.inet_pton(socket.AF_INET6, ip)
-        return rawIp.startswith(b'\x00' * 10 + b'\xff' * 2)
-    except socket.error:
-        return False
-
-
-def extractIpv4FromIpv6(ip: str) -> str:
-    if not isIpv4MappedIpv6(ip):
-        raise ValueError(f"{ip} is not an IPv4-mapped IPv6 address")
+IPV4_MAPPED_PREFIX: bytes = b'\x00' * 10 + b'\xff' * 2
+LOOPBACK_IPS: frozenset[str] = frozenset(("127.0.0.1", "::1", "0:0:0:0:0:0:0:1"))
 
-    rawIpv6 = socket.inet_pton(socket.AF_INET6, ip)
-    rawIpv4 = rawIpv6[-4:]
-    return socket.inet_ntop(socket.AF_INET, rawIpv4)
 
-
-def writeLog(family: str, ip: str, port: int) -> None:
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_entry = f"[{timestamp}] [{family}] Caught {ip} on port {port}"
-    print(log_entry, flush=True)
+def unmapIpv4(ip: str) -> str:
     try:
-        with open("/var/log/iptrap.log", "a") as f:
-            f.write(log_entry)
-            f.write('\n')
-    except BaseException as e:
-        print(f"[!] Failed to write log to file: {type(e).__name__} - {e}", file=sys.stderr)
+        rawIp = socket.inet_pton(socket.AF_INET6, ip)
+    except socket.error:
+        return ip
+    if rawIp[:12] == IPV4_MAPPED_PREFIX:
+        return socket.inet_ntop(socket.AF_INET, rawIp[12:])
+    return ip
 
 
-def banIp_firewalld(ip: str, family: str) -> None:
-    print(f"Adding firewalld rule for {ip}", flush=True)
+def banIps_firewalld(bans: dict[str, str]) -> None:
+    print(f"Adding firewalld rules for {', '.join(bans)}", flush=True)
+    command = ["firewall-cmd"]
+    for ip, family in bans.items():
+        command.append(f"--add-rich-rule=rule family=\"{family}\" source address=\"{ip}\" drop")
     try:
-        subprocess.run(["firewall-cmd", "--add-rich-rule", f"rule family=\"{family}\" source address=\"{ip}\" drop"])
+        subprocess.run(command)
     except BaseException as e:
         print(f"[!] Failed to run command: {type(e).__name__} - {e}", file=sys.stderr)
 
@@ -59,49 +57,130 @@ def apply_firewalld() -> None:
 
 
 class Trap(Process):
-    def __init__(self, port: int):
-        super().__init__(name=f"IPTrap on port {port}", daemon=True)
+    def __init__(self, port: int, index: int = 0):
+        super().__init__(name=f"IPTrap #{index} on port {port}", daemon=True)
         self.s: socket.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
         self.port: int = port
+        self.logFile: TextIO | None = None
+        self.pendingBans: dict[str, str] = {}
+        self.banLock: threading.Lock | None = None
+        self.stopEvent = Event()
 
     def stop(self) -> None:
+        # Only ask the trap to stop, it still has to flush its pending bans before exiting
         print(f"Stopping {self.name}", flush=True)
         try:
-            self.s.shutdown(socket.SHUT_RDWR)
+            self.stopEvent.set()
             self.s.close()
-            self.terminate()
         except BaseException as e:
             if type(e) is not KeyboardInterrupt:
                 print(f"[!] Error stopping {self.name}: {type(e).__name__} - {e}", file=sys.stderr)
 
+    def writeLog(self, family: str, ip: str) -> None:
+        timestamp = datetime.datetime.now().isoformat(sep=" ", timespec="seconds")
+        print(f"[{timestamp}] [{family}] Caught {ip} on port {self.port}", flush=True)
+        try:
+            # Reopen the log if it could not be opened before or was moved away by logrotate
+            if self.logFile is None or not self.isLogCurrent():
+                self.openLog()
+            # Tab-separated so that iptrap-analyze.py can load it without any regex parsing
+            self.logFile.write(f"{timestamp}\t{family}\t{ip}\t{self.port}\n")
+        except BaseException as e:
+            print(f"[!] Failed to write log to file: {type(e).__name__} - {e}", file=sys.stderr)
+
+    def openLog(self) -> None:
+        if self.logFile is not None:
+            self.logFile.close()
+            self.logFile = None
+        # Keep the log open between writes, line buffering flushes every entry
+        self.logFile = open(LOG_PATH, "a", buffering=1)
+
+    def isLogCurrent(self) -> bool:
+        try:
+            pathStat = os.stat(LOG_PATH)
+        except FileNotFoundError:
+            return False
+        fileStat = os.fstat(self.logFile.fileno())
+        return (pathStat.st_dev, pathStat.st_ino) == (fileStat.st_dev, fileStat.st_ino)
+
+    def queueBan(self, ip: str, family: str) -> None:
+        with self.banLock:
+            self.pendingBans[ip] = family
+            full = len(self.pendingBans) >= BAN_BATCH_SIZE
+        if full:
+            self.flushBans()
+
+    def flushBans(self) -> None:
+        with self.banLock:
+            bans, self.pendingBans = self.pendingBans, {}
+        if bans:
+            banIps_firewalld(bans)
+
+    def flushBansPeriodically(self) -> None:
+        while not self.stopEvent.wait(BAN_FLUSH_INTERVAL):
+            self.flushBans()
+
     def run(self) -> None:
         print(f"Starting {self.name}", flush=True)
+        # Shutdown is driven by the parent through stop(), signals must not interrupt the final flush of pending bans
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        self.banLock = threading.Lock()
+        flusher = threading.Thread(target=self.flushBansPeriodically, name=f"{self.name} ban flusher", daemon=True)
+        flusher.start()
+        try:
+            self.openLog()
+        except BaseException as e:
+            print(f"[!] Failed to open log file: {type(e).__name__} - {e}", file=sys.stderr)
         self.s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
         self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             self.s.bind(("::", self.port))
-            self.s.listen(5)
-            while True:
-                c, addr = self.s.accept()
-#                c.send(bytearray("BUSTED\n", encoding="ASCII"))
-                c.close()
-                ip = extractIpv4FromIpv6(addr[0]) if isIpv4MappedIpv6(addr[0]) else addr[0]
-                if isLoopback(ip):
-                    continue
-                family = "ipv4" if ":" not in ip else "ipv6"
-                writeLog(family, ip, self.port)
-                banIp_firewalld(ip, family)
+            self.s.listen(LISTEN_BACKLOG)
+            self.s.setblocking(False)
+            selector = selectors.DefaultSelector()
+            selector.register(self.s, selectors.EVENT_READ)
+            while not self.stopEvent.is_set():
+                selector.select(BAN_FLUSH_INTERVAL)
+                # Drain every pending connection before waiting again
+                while True:
+                    try:
+                        c, addr = self.s.accept()
+                    except BlockingIOError:
+                        break
+#                    c.send(bytearray("BUSTED\n", encoding="ASCII"))
+                    c.close()
+                    ip = unmapIpv4(addr[0])
+                    if ip in LOOPBACK_IPS:
+                        continue
+                    family = "ipv4" if ":" not in ip else "ipv6"
+                    self.writeLog(family, ip)
+                    self.queueBan(ip, family)
         except BaseException as e:
             if type(e) is not KeyboardInterrupt:
                 print(f"[!] Error running {self.name}: {type(e).__name__} - {e}", file=sys.stderr)
+        finally:
+            self.stopEvent.set()
+            flusher.join()
+            self.flushBans()
+            if self.logFile is not None:
+                self.logFile.close()
 
 
 def main():
     ports = []
     traps = []
+    trapsPerPort: int = DEFAULT_TRAPS_PER_PORT
 
     for a in sys.argv[1:]:
         try:
+            if a.startswith("--traps="):
+                count: int = int(a.removeprefix("--traps="))
+                if count <= 0:
+                    raise ValueError
+                trapsPerPort = count
+                continue
             port: int = int(a)
             if port <= 0:
                 raise ValueError
@@ -119,17 +198,23 @@ def main():
     signal.signal(signal.SIGTERM, shutdownHook)
 
     for port in ports:
-        trap: Trap = Trap(port)
-        traps.append(trap)
-        trap.start()
+        for i in range(trapsPerPort):
+            trap: Trap = Trap(port, i)
+            traps.append(trap)
+            trap.start()
 
     try:
         while True:
             time.sleep(1000)
     except BaseException:
+        # A repeated signal must not abort the shutdown before the rules are saved
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
         print(f"\nStopping", flush=True)
         for trap in traps:
             trap.stop()
+        for trap in traps:
+            trap.join()
         apply_firewalld()
 
 